@@ -1,125 +1,238 @@
 # ─── 1. Install and import tools ─────────────────────────────────────────────
-import os, io, json, base64, requests
+import os, io, re, asyncio, shelve, requests
 from datetime import datetime
 from pathlib import Path
+from zoneinfo import ZoneInfo
 from io import BytesIO
 
 import pandas as pd
+import blake3
+import httpx
 import openai
-import pytz
+import orjson
 import pillow_heif
-from PIL import Image, UnidentifiedImageError
+import pybase64
+from PIL import Image, ImageOps, UnidentifiedImageError
 from pdf2image import convert_from_bytes
 
 import gspread
+from google.auth.transport.requests import AuthorizedSession
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from gspread_dataframe import get_as_dataframe, set_with_dataframe
+from requests.adapters import HTTPAdapter
+from gspread.utils import rowcol_to_a1
+from gspread_dataframe import get_as_dataframe
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 # Enable HEIF support
 pillow_heif.register_heif_opener()
 
 # ─── 2. Authenticate Google Drive / Sheets ───────────────────────────────────
 SERVICE_ACCOUNT_FILE = "credentials.json"
-if not os.path.exists(SERVICE_ACCOUNT_FILE):
-    with open(SERVICE_ACCOUNT_FILE, "w") as f:
-        f.write(os.getenv("GOOGLE_CREDENTIALS_JSON"))
-
 SCOPES = [
     "https://www.googleapis.com/auth/drive",
     "https://www.googleapis.com/auth/spreadsheets"
 ]
-creds = service_account.Credentials.from_service_account_file(
-    SERVICE_ACCOUNT_FILE, scopes=SCOPES
-)
+
+# Prefer the JSON in the environment (never written to disk); fall back to a
+# local credentials.json for runs outside GitHub Actions
+creds_json = os.getenv("GOOGLE_CREDENTIALS_JSON")
+if creds_json:
+    creds = service_account.Credentials.from_service_account_info(
+        orjson.loads(creds_json), scopes=SCOPES
+    )
+else:
+    creds = service_account.Credentials.from_service_account_file(
+        SERVICE_ACCOUNT_FILE, scopes=SCOPES
+    )
 gc = gspread.authorize(creds)
-drive_service = build("drive", "v3", credentials=creds)
+
+# One pooled session shared by all workers so Drive downloads reuse TLS/TCP
+# connections; AuthorizedSession refreshes the access token as needed
+http_session = AuthorizedSession(creds)
+http_session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+DRIVE_MEDIA_URL = "https://www.googleapis.com/drive/v3/files/{}?alt=media"
+
+# File ids come from editable sheet cells and the request carries our bearer
+# token, so only plain ids may be put into the URL
+_DRIVE_FILE_ID = re.compile(r"[\w-]+")
 
 # ─── 3. Load Sheet and Detect Image Column ───────────────────────────────────
 SHEET_URL = "stop this flow"
 sh = gc.open_by_url(SHEET_URL)
 worksheet = sh.get_worksheet(0)
 
-# Load DataFrame and drop empty photo rows
-df = get_as_dataframe(worksheet).dropna(subset=["Photo"]).reset_index(drop=True)
+# Load DataFrame and collapse stray whitespace in headers
+_WS = re.compile(r"\s+")
+_PHOTO = re.compile(r"photo", re.I)
+
+def tidy_header(name):
+    return _WS.sub(" ", str(name).strip())
+
+# Blank rows are kept so df.index + 2 is always the row number on the sheet.
+# get_as_dataframe drops unnamed empty columns, so column positions for the
+# write-back come from the real header row instead of df.columns.
+df = get_as_dataframe(worksheet, skip_blank_lines=False, drop_empty_rows=False)
+df.columns = [tidy_header(c) for c in df.columns]
+sheet_header = [tidy_header(h) for h in worksheet.row_values(1)]
+
+# Detect the image column and drop empty photo rows
+photo_col = next((c for c in df.columns if _PHOTO.search(c)), None)
+if photo_col is None:
+    raise ValueError("No photo column found in sheet")
+df = df.dropna(subset=[photo_col])
 
 # ─── 4. Fetch Image Bytes ────────────────────────────────────────────────────
+# Returns None for entries that can't be downloaded; download and decode
+# errors propagate to process_row, which logs them and marks the row "Error"
 def fetch_image_bytes(path_or_url):
-    try:
-        # Skip local drive paths (not supported outside Colab)
-        if path_or_url.startswith("/content/drive/"):
-            print("Local Colab drive path not supported in GitHub Actions.")
-            return None
-
-        # Handle Google Drive share URLs
-        if "open?id=" in path_or_url:
-            file_id = path_or_url.split("open?id=")[-1]
-        elif "/file/d/" in path_or_url:
-            file_id = path_or_url.split("/file/d/")[1].split("/")[0]
-        else:
-            raise ValueError("Unrecognized Photo entry")
-
-        # Download image from Google Drive
-        request = drive_service.files().get_media(fileId=file_id)
-        fh = BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
-        fh.seek(0)
-
-        # Open image in RGB format (now supports HEIC too)
-        img = Image.open(fh).convert("RGB")
-        buf = BytesIO(); img.save(buf, format="JPEG")
-        return buf.getvalue()
+    path_or_url = str(path_or_url)
 
-    except Exception as e:
-        print(f"Error loading image: {e}")
+    # Skip local drive paths (not supported outside Colab)
+    if path_or_url.startswith("/content/drive/"):
+        print("Local Colab drive path not supported in GitHub Actions.")
         return None
 
-# Helper function to base64-encode image bytes
-def encode_image_bytes(img_bytes):
-    return base64.b64encode(img_bytes).decode("utf-8")
+    # Handle Google Drive share URLs
+    if "open?id=" in path_or_url:
+        file_id = path_or_url.split("open?id=")[-1]
+    elif "/file/d/" in path_or_url:
+        file_id = path_or_url.split("/file/d/")[1].split("/")[0]
+    else:
+        print(f"Error loading image: unrecognized Photo entry {path_or_url!r}")
+        return None
+    if not _DRIVE_FILE_ID.fullmatch(file_id):
+        print(f"Error loading image: invalid Drive file id {file_id!r}")
+        return None
+
+    # Download image from Google Drive
+    resp = http_session.get(DRIVE_MEDIA_URL.format(file_id), timeout=60)
+    resp.raise_for_status()
+    return _to_jpeg(resp.content)
+
+# Convert image bytes to a JPEG no larger than MAX_SIDE on either edge;
+# GPT-4o downsizes anyway, so bigger uploads only cost encode time and bandwidth
+JPEG_MAGIC = b"\xff\xd8\xff"
+PDF_MAGIC = b"%PDF"
+MAX_SIDE = 1024
+
+def _to_jpeg(img_bytes):
+    if img_bytes[:4] == PDF_MAGIC:
+        # Rasterize the first page only, straight to MAX_SIDE (Poppler -scale-to);
+        # Poppler is never spawned for images
+        img = convert_from_bytes(img_bytes, size=MAX_SIDE, first_page=1, last_page=1)[0]
+    else:
+        # Opening only reads the header, so checking size, mode and EXIF is
+        # cheap. CMYK/YCCK JPEGs still need converting to RGB, and JPEGs with
+        # EXIF are re-encoded so GPS/device metadata never leaves this script.
+        img = Image.open(BytesIO(img_bytes))
+        if (
+            img_bytes[:3] == JPEG_MAGIC
+            and img.mode in ("RGB", "L")
+            and max(img.size) <= MAX_SIDE
+            and not img.getexif()
+        ):
+            return img_bytes
+
+        # Let libjpeg decode large JPEGs at a reduced DCT scale (no-op otherwise)
+        img.draft("RGB", (MAX_SIDE, MAX_SIDE))
+
+        # Apply the EXIF Orientation tag, since the re-encode drops it
+        img = ImageOps.exif_transpose(img)
+
+    # Open image in RGB format (now supports HEIC too)
+    img = img.convert("RGB")
+    img.thumbnail((MAX_SIDE, MAX_SIDE), Image.Resampling.LANCZOS)
+    buf = BytesIO()
+    img.save(buf, format="JPEG", quality=85, subsampling=2, optimize=True, progressive=True)
+    return buf.getvalue()
+
+# Helper function to build the image data URI (SIMD-accelerated base64).
+# pybase64 returns a str directly, so the prefix concat is the only other copy.
+DATA_URI_PREFIX = "data:image/jpeg;base64,"
+
+def jpeg_data_uri(jpeg):
+    return DATA_URI_PREFIX + pybase64.b64encode_as_string(jpeg)
 
 # ─── 5. GPT Assessment ───────────────────────────────────────────────────────
-openai.api_key = os.getenv("OPENAI_API_KEY")
-
-def get_nail_assessment(b64_img):
-    prompt = (
-        "You are a nail technician recruiter.\n"
-        "If the nail job photo does NOT show exactly 1 dark-colored nail, 2 light-colored nails, "
-        "and 2 French manicure nails (natural base with clean white tips), respond with this JSON:\n"
-        "{\n"
-        "  \"Polish Application\": \"0.0/10 – Wrong format\",\n"
-        "  \"Cuticle Work\":       \"0.0/10 – Wrong format\",\n"
-        "  \"Nail Shape\":         \"0.0/10 – Wrong format\",\n"
-        "  \"Cleanliness\":        \"0.0/10 – Wrong format\",\n"
-        "  \"Overall Score\":      0.0,\n"
-        "  \"Recommendation\":     \"Wrong Format\"\n"
-        "}\n"
-        "Otherwise, assess the image and return a JSON object with:\n"
-        "- Score out of 10 and short comment (2–4 words) for each:\n"
-        "  • Polish Application\n"
-        "  • Cuticle Work\n"
-        "  • Nail Shape\n"
-        "  • Cleanliness\n"
-        "- Then compute average score as 'Overall Score'\n"
-        "- And a 'Recommendation' from:\n"
-        "  • 'Highly Recommend Hire' if ≥ 8.5\n"
-        "  • 'Recommend Hire' if ≥ 7\n"
-        "  • 'Further Training Required' if ≥ 5.5\n"
-        "  • 'Not Recommend Hire' if < 5.5\n"
-        "Respond ONLY with the JSON object. No extra text."
-    )
+# One HTTP/2 keep-alive client: concurrent rows multiplex over shared
+# connections instead of paying a TLS handshake each
+client = openai.AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_retries=0,  # create_completion's tenacity retry is the only retry layer
+    http_client=openai.DefaultAsyncHttpxClient(
+        http2=True, limits=httpx.Limits(max_connections=32)
+    ),
+)
+
+# Back off on 429s, honoring the server's Retry-After header when present
+_backoff = wait_exponential(multiplier=1, min=1, max=60)
 
-    resp = openai.chat.completions.create(
-        model="gpt-4o",
+def _wait_retry_after(retry_state):
+    exc = retry_state.outcome.exception()
+    retry_after = exc.response.headers.get("retry-after")
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return _backoff(retry_state)
+
+@retry(
+    retry=retry_if_exception_type(openai.RateLimitError),
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def create_completion(**kwargs):
+    return await client.chat.completions.create(**kwargs)
+
+MODEL = "gpt-4o"
+SYSTEM_PROMPT = "You are a precise JSON-only assistant."
+PROMPT = (
+    "You are a nail technician recruiter.\n"
+    "If the nail job photo does NOT show exactly 1 dark-colored nail, 2 light-colored nails, "
+    "and 2 French manicure nails (natural base with clean white tips), respond with this JSON:\n"
+    "{\n"
+    "  \"Polish Application\": \"0.0/10 – Wrong format\",\n"
+    "  \"Cuticle Work\":       \"0.0/10 – Wrong format\",\n"
+    "  \"Nail Shape\":         \"0.0/10 – Wrong format\",\n"
+    "  \"Cleanliness\":        \"0.0/10 – Wrong format\",\n"
+    "  \"Overall Score\":      0.0,\n"
+    "  \"Recommendation\":     \"Wrong Format\"\n"
+    "}\n"
+    "Otherwise, assess the image and return a JSON object with:\n"
+    "- Score out of 10 and short comment (2–4 words) for each:\n"
+    "  • Polish Application\n"
+    "  • Cuticle Work\n"
+    "  • Nail Shape\n"
+    "  • Cleanliness\n"
+    "- Then compute average score as 'Overall Score'\n"
+    "- And a 'Recommendation' from:\n"
+    "  • 'Highly Recommend Hire' if ≥ 8.5\n"
+    "  • 'Recommend Hire' if ≥ 7\n"
+    "  • 'Further Training Required' if ≥ 5.5\n"
+    "  • 'Not Recommend Hire' if < 5.5\n"
+    "Respond ONLY with the JSON object. No extra text."
+)
+
+# Assessments are cached on disk by image content, model and prompt, so reruns
+# and duplicate photos skip the API call. Only the event loop touches it.
+CACHE_PATH = Path(".cache/gpt_nail.db")
+CACHE_PATH.parent.mkdir(exist_ok=True)
+gpt_cache = shelve.open(str(CACHE_PATH))
+PROMPT_HASH = blake3.blake3(f"{SYSTEM_PROMPT}\n{PROMPT}".encode()).hexdigest()
+
+async def get_nail_assessment(jpeg):
+    key = f"{blake3.blake3(jpeg).hexdigest()}:{MODEL}:{PROMPT_HASH}"
+    cached = gpt_cache.get(key)
+    if cached is not None:
+        return cached
+
+    resp = await create_completion(
+        model=MODEL,
         messages=[
-            {"role": "system", "content": "You are a precise JSON-only assistant."},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": [
-                {"type": "text", "text": prompt},
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64_img}"}}
+                {"type": "text", "text": PROMPT},
+                {"type": "image_url", "image_url": {"url": jpeg_data_uri(jpeg)}}
             ]}
         ],
         max_tokens=200
@@ -129,66 +242,130 @@ def get_nail_assessment(b64_img):
     start, end = raw.find('{'), raw.rfind('}')
     if start == -1 or end == -1:
         raise ValueError(f"No JSON found in response: {raw!r}")
-    json_str = raw[start:end+1]
-    return json.loads(json_str)
+    assessment = orjson.loads(raw[start:end+1])
+    gpt_cache[key] = assessment
+    return assessment
 
 # ─── 6. Process New Rows Only ────────────────────────────────────────────────
-results = []
 timestamp_col = "Timestamp Rating"
+result_cols = [
+    "Polish Application",
+    "Cuticle Work",
+    "Nail Shape",
+    "Cleanliness",
+    "Overall Score",
+    "Recommendation",
+]
+
+# GPT sometimes varies key case/spacing, or nests {score, comment}; map keys
+# onto result_cols once here rather than per row
+def _norm_key(key):
+    return key.lower().replace(" ", "")
+
+STD_KEYS = {_norm_key(c): c for c in result_cols}
+
+def normalize_assessment(res):
+    flattened = {STD_KEYS.get(_norm_key(k), k): v for k, v in res.items()}
+    return {
+        c: f"{v.get('score')}, {v.get('comment')}" if isinstance(v, dict)
+        else "None" if v is None else v
+        for c, v in ((c, flattened.get(c)) for c in result_cols)
+    }
+
+# Rows in flight at once; keep this low enough to stay under OpenAI rate limits
+MAX_CONCURRENCY = int(os.getenv("NAIL_MAX_CONCURRENCY", "20"))
 
 # Ensure Timestamp Rating column exists
 if timestamp_col not in df.columns:
     df[timestamp_col] = ""
 
 # Get current Boston (EDT) time
-boston_now = lambda: datetime.now(pytz.timezone('America/New_York')).strftime("%Y-%m-%d %H:%M:%S")
+BOSTON_TZ = ZoneInfo("America/New_York")
 
-for idx, row in df.iterrows():
-    # Skip already rated rows
-    if pd.notnull(row.get(timestamp_col)) and str(row[timestamp_col]).strip() != "":
-        print(f"Skipping row {idx} — already rated.")
-        results.append(None)
-        continue
+def boston_now():
+    return datetime.now(BOSTON_TZ).strftime("%Y-%m-%d %H:%M:%S")
 
-    # Load and process image
-    img_bytes = fetch_image_bytes(row["Photo"])
+def error_result():
+    res = {col: "Error" for col in result_cols}
+    res[timestamp_col] = boston_now()
+    return res
+
+async def process_row(idx, url):
+    # Load and process image (blocking download + Pillow work off the loop).
+    # Any failure only fails this row, so the sheet write still runs.
+    try:
+        img_bytes = await asyncio.to_thread(fetch_image_bytes, url)
+    except Exception as e:
+        print(f"❌ Error loading image on row {idx}: {e}")
+        return idx, error_result()
     if not img_bytes:
         print(f"Skipping row {idx}: could not load image.")
-        results.append({
-            "Polish Application": "Error",
-            "Cuticle Work":       "Error",
-            "Nail Shape":         "Error",
-            "Cleanliness":        "Error",
-            "Overall Score":      "Error",
-            "Recommendation":     "Error",
-            timestamp_col:        boston_now()
-        })
-        continue
+        return idx, error_result()
 
     # Assess via GPT
     try:
-        assessment = get_nail_assessment(encode_image_bytes(img_bytes))
+        assessment = normalize_assessment(await get_nail_assessment(img_bytes))
         assessment[timestamp_col] = boston_now()
-        results.append(assessment)
         print(f"✅ Row {idx} rated at {assessment[timestamp_col]}")
+        return idx, assessment
     except Exception as e:
         print(f"❌ Error on row {idx}: {e}")
-        results.append({
-            "Polish Application": "Error",
-            "Cuticle Work":       "Error",
-            "Nail Shape":         "Error",
-            "Cleanliness":        "Error",
-            "Overall Score":      "Error",
-            "Recommendation":     "Error",
-            timestamp_col:        boston_now()
-        })
+        return idx, error_result()
+
+results = {}
+# Skip already rated rows
+already_rated = df[timestamp_col].fillna("").astype(str).str.strip() != ""
+print(f"Skipping {already_rated.sum()} rows — already rated.")
+pending = df.index[~already_rated]
+
+async def rate_rows(rows):
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def one(idx, url):
+        async with sem:
+            return await process_row(idx, url)
+
+    try:
+        return await asyncio.gather(*(one(idx, url) for idx, url in rows))
+    finally:
+        await client.close()
+
+for idx, res in asyncio.run(rate_rows(df.loc[pending, photo_col].items())):
+    results[idx] = res
 
 # ─── 7. Write Results to Google Sheet ────────────────────────────────────────
-for i, res in enumerate(results):
-    if res is None:
-        continue
-    for col, val in res.items():
-        df.loc[i, col] = val
+def _runs(nums):
+    """Group sorted integers into (first, last) runs of consecutive values."""
+    runs = []
+    for n in map(int, nums):
+        if runs and n == runs[-1][1] + 1:
+            runs[-1][1] = n
+        else:
+            runs.append([n, n])
+    return runs
+
+# Write only the rated cells (plus headers for new columns) in one API call
+if results:
+    res_df = pd.DataFrame.from_dict(results, orient="index").sort_index()
+    # New columns go after the last named header on the sheet
+    new_cols = [col for col in res_df.columns if col not in sheet_header]
+    columns = sheet_header + new_cols
+    data = [
+        {"range": rowcol_to_a1(1, pos + 1), "values": [[col]]}
+        for pos, col in enumerate(new_cols, start=len(sheet_header))
+    ]
+    col_pos = sorted(columns.index(col) + 1 for col in res_df.columns)
+    for r0, r1 in _runs(res_df.index + 2):
+        for c0, c1 in _runs(col_pos):
+            block = res_df.loc[r0 - 2:r1 - 2, columns[c0 - 1:c1]]
+            data.append({
+                "range": f"{rowcol_to_a1(r0, c0)}:{rowcol_to_a1(r1, c1)}",
+                "values": block.fillna("").values.tolist(),
+            })
+
+    if worksheet.col_count < len(columns):
+        worksheet.add_cols(len(columns) - worksheet.col_count)
+    worksheet.batch_update(data, value_input_option="USER_ENTERED")
 
-set_with_dataframe(worksheet, df)
+gpt_cache.close()
 print("✅ Completed all updates.")